@@ -0,0 +1,91 @@
+"""Module with the index for searching avatars by the part of their names."""
+
+from bisect import bisect_left
+from bisect import bisect_right
+from typing import Mapping
+
+
+class AvatarNameIndex:
+    """Index of avatar names for the case-insensitive CONTAINS search.
+
+    Names and targets are compared case-folded, so for example "Straße" is found by "STRASSE".
+    Every suffix of every case-folded avatar name is kept in one sorted list together with the position of its avatar.
+    A name contains the target only if one of its suffixes starts with the target, and all such suffixes are next to
+    each other in the sorted list, so they are found by a binary search instead of checking every name.
+    Short targets match too many suffixes for that, so they are searched with a single find over all names joined
+    together, which stops at the first match.
+    Found avatars are remembered for the most recent targets, so repeated targets skip the search, until the index is
+    rebuilt for a changed map.
+    """
+
+    FOUND_AVATARS_CACHE_SIZE = 128
+    SHORT_TARGET_LENGTH = 2
+    NAMES_SEPARATOR = "\x00"
+
+    def __init__(self, avatars_map: Mapping[str, str]) -> None:
+        """Build the index from the given map.
+
+        :param avatars_map: Dict/Map, where key - avatar id, value - avatar name.
+        """
+        self._build(avatars_map)
+
+    def update(self, avatars_map: Mapping[str, str]) -> None:
+        """Rebuild the index if the given map differs from the indexed one, including changes made in place.
+
+        :param avatars_map: Dict/Map, where key - avatar id, value - avatar name.
+        """
+        if avatars_map is not self.avatars_map or list(avatars_map.items()) != self._avatars:
+            self._build(avatars_map)
+
+    def _build(self, avatars_map: Mapping[str, str]) -> None:
+        """Build the index from the snapshot of the given map and forget avatars found in the previous one."""
+        self.avatars_map = avatars_map
+        self._found_avatars: dict[str, tuple[str, str]] = {}
+        self._avatars: list[tuple[str, str]] = list(avatars_map.items())
+        suffixes: list[tuple[str, int]] = []
+        folded_avatar_names: list[str] = []
+        self._name_starts: list[int] = []
+        name_start = 0
+        for position, (_, avatar_name) in enumerate(self._avatars):
+            folded_avatar_name = avatar_name.casefold()
+            suffixes.extend((folded_avatar_name[start:], position) for start in range(len(folded_avatar_name)))
+            folded_avatar_names.append(folded_avatar_name)
+            self._name_starts.append(name_start)
+            name_start += len(folded_avatar_name) + len(self.NAMES_SEPARATOR)
+        self._joined_names = self.NAMES_SEPARATOR.join(folded_avatar_names)
+        suffixes.sort()
+        self._suffixes = [suffix for suffix, _ in suffixes]
+        self._suffix_positions = [position for _, position in suffixes]
+
+    def find(self, target_avatar_name: str) -> tuple[str, str] | None:
+        """Find the first avatar in the map order whose name contains the target avatar name.
+
+        :param target_avatar_name: Target avatar name that should partially match the avatar name.
+        :return: Avatar id and name if any avatar was found, otherwise None.
+        """
+        if (found_avatar := self._found_avatars.pop(target_avatar_name, None)) is None:
+            if (found_avatar := self._search(target_avatar_name)) is None:
+                return None
+            if len(self._found_avatars) >= self.FOUND_AVATARS_CACHE_SIZE:
+                del self._found_avatars[next(iter(self._found_avatars))]
+        self._found_avatars[target_avatar_name] = found_avatar
+        return found_avatar
+
+    def _search(self, target_avatar_name: str) -> tuple[str, str] | None:
+        """Search the first avatar in the map order whose name contains the target avatar name using the index."""
+        target_name = target_avatar_name.casefold()
+        if len(target_name) <= self.SHORT_TARGET_LENGTH:
+            return self._search_joined_names(target_name)
+        start = bisect_left(self._suffixes, target_name)
+        end = bisect_right(self._suffixes, target_name, lo=start, key=lambda suffix: suffix[: len(target_name)])
+        if start == end:
+            return None
+        return self._avatars[min(self._suffix_positions[start:end])]
+
+    def _search_joined_names(self, target_name: str) -> tuple[str, str] | None:
+        """Search the first avatar whose name contains the case-folded target name in the joined avatar names."""
+        if not self._avatars or self.NAMES_SEPARATOR in target_name:
+            return None
+        if (match_start := self._joined_names.find(target_name)) == -1:
+            return None
+        return self._avatars[bisect_right(self._name_starts, match_start) - 1]
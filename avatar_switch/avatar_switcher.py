@@ -1,22 +1,41 @@
 """Module with the class for switching to specific avatars."""
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
 from typing import Mapping
-from urllib.error import HTTPError
 
+import orjson
+from requests import HTTPError
+from requests import Response
 from requests import codes
 from tenacity import retry
-from tenacity import retry_if_exception_type
+from tenacity import retry_if_exception
 from tenacity import stop_after_attempt
-from tenacity import wait_fixed
+from tenacity import wait_random_exponential
 
+from avatar_switch.avatar_index import AvatarNameIndex
 from avatar_switch.errors import AuthenticationRequiredError
 from avatar_switch.errors import AvatarNotFoundError
+from avatar_switch.vrchat_api import MAX_RETRY_WAIT_SECONDS
+from avatar_switch.vrchat_api import RETRY_STATUS_CODES
 from avatar_switch.vrchat_api import VRChatAPI
 
 logger = logging.getLogger("vrchat-avatar-switch")
 
 
+def _is_retryable_server_error(error: BaseException) -> bool:
+    """Check if the error is a server error that was not already retried by the VRChat API rate limit policy."""
+    return (
+        isinstance(error, HTTPError)
+        and error.response is not None
+        and error.response.status_code >= codes.internal_server_error
+        and error.response.status_code not in RETRY_STATUS_CODES
+    )
+
+
 class AvatarSwitcher:
     """Class that is responsible for switching to avatars.
 
@@ -25,56 +44,198 @@ class AvatarSwitcher:
     Handle possible VRChat API responses.
     """
 
+    AVATARS_CACHE_FILE_PATH = "avatars_cache.json"
+    AVATARS_CACHE_TTL_SECONDS = 60 * 60
+    FAVORITE_AVATARS_PAGE_WORKERS = 4
+
     def __init__(self, api: VRChatAPI) -> None:
         """Initialize with the provided VRChatAPI with initialized request session."""
         self.api = api
+        self._avatar_index: AvatarNameIndex | None = None
+        self._favorite_avatars: dict[str, str] | None = None
+        self._revalidate_avatars_cache = False
+        self._avatars_cache_path = Path(self.AVATARS_CACHE_FILE_PATH)
 
-    retry(
-        retry=retry_if_exception_type(HTTPError),
-        stop=stop_after_attempt(10),
-        wait=wait_fixed(2),
+    @retry(
+        retry=retry_if_exception(_is_retryable_server_error),
+        stop=stop_after_attempt(5),
+        wait=wait_random_exponential(multiplier=1, max=MAX_RETRY_WAIT_SECONDS),
         reraise=True,
     )
-
     def switch_avatar_by_name(self, avatars_map: Mapping[str, str], target_avatar_name: str) -> None:
         """Switch to the avatar that contains target avatar name using id from provided map.
 
         :param avatars_map: Dict/Map, where key - avatar id, value - avatar name.
         :param target_avatar_name: Target avatar name that should partially match the avatar name from the map.
         """
-        if target_avatar_name is None:
+        if target_avatar_name is None or not target_avatar_name.strip():
             raise AvatarNotFoundError(f"Empty target avatar name was specified")
-        for avatar_id, avatar_name in avatars_map.items():
-            if target_avatar_name.lower() in avatar_name.lower():
-                switch_avatar_response = self.api.switch_avatar(avatar_id)
-                if switch_avatar_response.ok:
-                    logger.info(f"Avatar was switched to `{avatar_name}`. Got: `{target_avatar_name}`")
-                    return None
-                elif switch_avatar_response.status_code in (codes.not_found, codes.forbidden):
-                    logger.error(f"No avatar was found with id: {avatar_id}, name: {avatar_name}")
-                    return None
-                elif switch_avatar_response.status_code == codes.bad_request:
-                    logger.error(
-                        f"Failed to switch to avatar {avatar_name} - {avatar_id}. The request returned a 401 status "
-                        f"code. Reauthentication is needed."
-                    )
-                    raise AuthenticationRequiredError(
-                        "Request to switch avatar returned a 401 status code, "
-                        "meaning authentication cookies are expired or missing"
-                    )
-                else:
-                    logger.error(
-                        f"Unexpected status code {switch_avatar_response.status_code} received in the request to "
-                        f"switch avatar to {avatar_name} - {avatar_id}."
-                    )
-                    switch_avatar_response.raise_for_status()
+        if found_avatar := self._get_avatar_index(avatars_map).find(target_avatar_name):
+            avatar_id, avatar_name = found_avatar
+            switch_avatar_response = self.api.switch_avatar(avatar_id)
+            if switch_avatar_response.ok:
+                logger.info(f"Avatar was switched to `{avatar_name}`. Got: `{target_avatar_name}`")
+                return None
+            elif switch_avatar_response.status_code in (codes.not_found, codes.forbidden):
+                logger.error(f"No avatar was found with id: {avatar_id}, name: {avatar_name}")
+                return None
+            elif switch_avatar_response.status_code == codes.bad_request:
+                logger.error(
+                    f"Failed to switch to avatar {avatar_name} - {avatar_id}. The request returned a 401 status "
+                    f"code. Reauthentication is needed."
+                )
+                raise AuthenticationRequiredError(
+                    "Request to switch avatar returned a 401 status code, "
+                    "meaning authentication cookies are expired or missing"
+                )
+            else:
+                logger.error(
+                    f"Unexpected status code {switch_avatar_response.status_code} received in the request to "
+                    f"switch avatar to {avatar_name} - {avatar_id}."
+                )
+                switch_avatar_response.raise_for_status()
         raise AvatarNotFoundError(f"No avatar was found that contains: `{target_avatar_name}`")
 
     def get_all_favorite_avatars(self) -> dict[str, str]:
-        """Return all favorite avatars in format: id: name"""
-        avatars_response = self.api.get_avatars()
-        avatar_id_name_map: dict[str, str] = {}
-        if avatars_response.ok:
-            for avatar in avatars_response.json():
-                avatar_id_name_map[avatar["id"]] = avatar["name"]
+        """Return all favorite avatars in format: id: name
+
+        Favorite avatars are kept in memory and in the local cache file of the current user. The cache file is used
+        without any request while it is fresh, otherwise it is revalidated using its ETag.
+        """
+        if self._favorite_avatars is None:
+            if (avatar_id_name_map := self._fetch_favorite_avatars()) is None:
+                return {}
+            self._favorite_avatars = avatar_id_name_map
+            self._avatar_index = AvatarNameIndex(avatar_id_name_map)
+        return self._favorite_avatars
+
+    def clear_favorite_avatars_cache(self) -> None:
+        """Forget favorite avatars kept in memory and revalidate the local cache on the next request even if fresh."""
+        self._favorite_avatars = None
+        self._revalidate_avatars_cache = True
+
+    def _fetch_favorite_avatars(self) -> dict[str, str] | None:
+        """Return favorite avatars from the fresh local cache or from VRChat API.
+
+        If requesting them fails, the stale local cache or the avatars received before the failure are returned.
+        None is returned only if there are neither.
+        """
+        user_id = self.api.get_current_user_id()
+        cache = self._load_avatars_cache(user_id)
+        revalidate_cache, self._revalidate_avatars_cache = self._revalidate_avatars_cache, False
+        if cache and not revalidate_cache and time.time() - cache["fetched_at"] < self.AVATARS_CACHE_TTL_SECONDS:
+            logger.info("Using favorite avatars cached at %s", self._avatars_cache_path.absolute())
+            return cache["avatars"]
+
+        # ETag of the first page tells nothing about the next ones, so only single page caches are revalidated
+        cached_etag = cache["etag"] if cache and len(cache["avatars"]) < self.api.FAVORITE_AVATARS_PAGE_SIZE else None
+        avatars_response = self.api.get_avatars(etag=cached_etag)
+        if cached_etag and avatars_response.status_code == codes.not_modified:
+            logger.info("Favorite avatars were not modified since the last request. Using cached ones")
+            avatar_id_name_map = cache["avatars"]
+        elif avatars_response.ok:
+            avatar_id_name_map, is_complete = self._collect_favorite_avatars(avatars_response)
+            if not is_complete:
+                return self._get_fallback_favorite_avatars(cache, avatar_id_name_map)
+        else:
+            logger.error(f"Failed to get favorite avatars. Response: {avatars_response.text}")
+            return self._get_fallback_favorite_avatars(cache, None)
+        self._save_avatars_cache(avatar_id_name_map, avatars_response.headers.get("ETag", cached_etag), user_id)
         return avatar_id_name_map
+
+    def _collect_favorite_avatars(self, first_page_response: Response) -> tuple[dict[str, str], bool]:
+        """Collect ids and names of favorite avatars from the given first page and all pages following it.
+
+        If the first page is full, the following pages are requested concurrently in batches, one page per worker,
+        until a page that is not full is received. Only ids and names are kept from each parsed page.
+
+        :param first_page_response: Successful response to request the first page of favorite avatars.
+        :return: Dict, where key - avatar id, value - avatar name, and whether all pages were received. If any page
+            request has failed, avatars from the pages received before it are returned.
+        """
+        page_size = self.api.FAVORITE_AVATARS_PAGE_SIZE
+        first_page = orjson.loads(first_page_response.content)
+        avatar_id_name_map = {avatar["id"]: avatar["name"] for avatar in first_page}
+        if len(first_page) < page_size:
+            return avatar_id_name_map, True
+
+        batch_size = self.FAVORITE_AVATARS_PAGE_WORKERS * page_size
+        with ThreadPoolExecutor(max_workers=self.FAVORITE_AVATARS_PAGE_WORKERS) as executor:
+            offsets = range(page_size, page_size + batch_size, page_size)
+            while True:
+                for offset, page_response in zip(offsets, executor.map(self.api.get_avatars, offsets)):
+                    if not page_response.ok:
+                        logger.error(
+                            f"Failed to get favorite avatars from offset {offset}. Response: {page_response.text}"
+                        )
+                        return avatar_id_name_map, False
+                    page = orjson.loads(page_response.content)
+                    avatar_id_name_map.update((avatar["id"], avatar["name"]) for avatar in page)
+                    if len(page) < page_size:
+                        return avatar_id_name_map, True
+                offsets = range(offsets.stop, offsets.stop + batch_size, page_size)
+
+    def _get_fallback_favorite_avatars(
+        self, cache: dict[str, Any] | None, received_avatars: dict[str, str] | None
+    ) -> dict[str, str] | None:
+        """Return favorite avatars to use when requesting them has failed.
+
+        :param cache: Stale local cache of the current user if any.
+        :param received_avatars: Avatars received before the failure if any.
+        :return: Avatars from the stale cache if any, otherwise the received avatars.
+        """
+        if cache:
+            logger.warning("Using stale favorite avatars cached at %s", self._avatars_cache_path.absolute())
+            return cache["avatars"]
+        if received_avatars:
+            logger.warning("Using only %s favorite avatars received before the failure", len(received_avatars))
+        return received_avatars
+
+    def _save_avatars_cache(self, avatars_map: Mapping[str, str], etag: str | None, user_id: str | None) -> None:
+        """Save favorite avatars of the given user with their ETag and the current time locally if the user is known."""
+        if user_id is None:
+            logger.warning("Favorite avatars are not cached, since the current user is unknown")
+            return None
+        cache = {"fetched_at": time.time(), "etag": etag, "user_id": user_id, "avatars": avatars_map}
+        self._avatars_cache_path.write_bytes(orjson.dumps(cache))
+        return None
+
+    def _load_avatars_cache(self, user_id: str | None) -> dict[str, Any] | None:
+        """Load favorite avatars of the given user with their ETag and fetch time from the file if it is valid.
+
+        The cache is only an optimisation, so a missing, malformed or another user cache file is ignored.
+        """
+        try:
+            cache = orjson.loads(self._avatars_cache_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except orjson.JSONDecodeError:
+            logger.warning("Ignoring malformed favorite avatars cache at %s", self._avatars_cache_path.absolute())
+            return None
+        if not (
+            isinstance(cache, dict)
+            and isinstance(cache.get("fetched_at"), (int, float))
+            and isinstance(cache.get("etag"), (str, type(None)))
+            and isinstance(cache.get("avatars"), dict)
+        ):
+            logger.warning("Ignoring malformed favorite avatars cache at %s", self._avatars_cache_path.absolute())
+            return None
+        if user_id is None:
+            logger.warning("Ignoring favorite avatars cache, since the current user is unknown")
+            return None
+        if cache.get("user_id") != user_id:
+            logger.info("Ignoring favorite avatars cache of another user")
+            return None
+        return cache
+
+    def _get_avatar_index(self, avatars_map: Mapping[str, str]) -> AvatarNameIndex:
+        """Return the name index of the given map, rebuilding it only when another or changed map is given.
+
+        :param avatars_map: Dict/Map, where key - avatar id, value - avatar name.
+        :return: Name index of the given map.
+        """
+        if self._avatar_index is None:
+            self._avatar_index = AvatarNameIndex(avatars_map)
+        else:
+            self._avatar_index.update(avatars_map)
+        return self._avatar_index
@@ -1,33 +1,100 @@
 """The module contains class for interactive with VRChat API."""
 
-import json
 import logging
-import os
+import math
+import random
+import threading
+import time
 import urllib
 from datetime import datetime
+from http.cookiejar import LoadError
+from http.cookiejar import MozillaCookieJar
 from pathlib import Path
 from urllib.parse import urlencode
 
+import orjson
+from requests import RequestException
 from requests import Response
 from requests import Session
 from requests import codes
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from requests.cookies import cookiejar_from_dict
-from requests.utils import dict_from_cookiejar
+from tenacity import RetryCallState
+from tenacity import before_sleep_log
+from tenacity import retry
+from tenacity import retry_if_result
+from tenacity import stop_after_attempt
+from tenacity import wait_random_exponential
 
 logger = logging.getLogger("vrchat-avatar-switch")
 
+RETRY_STATUS_CODES = frozenset(
+    (codes.too_many_requests, codes.bad_gateway, codes.service_unavailable, codes.gateway_timeout)
+)
+MAX_RETRY_WAIT_SECONDS = 30
+
+_wait_exponential_jitter = wait_random_exponential(multiplier=1, max=MAX_RETRY_WAIT_SECONDS)
+
+
+def _wait_retry_after(retry_state: RetryCallState) -> float:
+    """Return the delay from the Retry-After header of the last response, or an exponential delay with jitter."""
+    response: Response = retry_state.outcome.result()
+    try:
+        retry_after = float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return _wait_exponential_jitter(retry_state)
+    if not math.isfinite(retry_after):
+        return _wait_exponential_jitter(retry_state)
+    return max(0.0, min(retry_after, MAX_RETRY_WAIT_SECONDS))
+
+
+retry_on_rate_limit = retry(
+    retry=retry_if_result(lambda response: response.status_code in RETRY_STATUS_CODES),
+    stop=stop_after_attempt(5),
+    wait=_wait_retry_after,
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+)
+
 
 class VRChatAPI:
     """Responsible for interacting with VRChat API."""
 
     BASE_URL = "https://vrchat.com/api/1"
-    COOKIES_FILE_PATH = "cookies.json"
+    SWITCH_AVATAR_URL_TEMPLATE = BASE_URL + "/avatars/{}/select"
+    COOKIES_FILE_PATH = "cookies.txt"
+    FAVORITE_AVATARS_PAGE_SIZE = 100
+    CURRENT_USER_REUSE_SECONDS = 2
+    JSON_HEADERS = {"Content-Type": "application/json"}
+    MFA_MAX_ATTEMPTS = 3
+    MFA_RETRY_MAX_WAIT_SECONDS = 10
+    KEEP_ALIVE_INTERVAL_SECONDS = 60
+    KEEP_ALIVE_TIMEOUT_SECONDS = 5
 
     def __init__(self) -> None:
-        """Initialise new requests session and set common required headers."""
+        """Initialise new requests session with a reusable connection pool and set common required headers."""
         self.session = Session()
-        self.session.headers = {"User-Agent": "vrchat-avatar-switch/1.0.0 https://github.com/Gliger13/vrchat_avatar_switcher"}
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "User-Agent": "vrchat-avatar-switch/1.0.0 https://github.com/Gliger13/vrchat_avatar_switcher",
+                "Connection": "keep-alive",
+            }
+        )
+        self._cookies_path = Path(self.COOKIES_FILE_PATH)
+        self._basic_auth: HTTPBasicAuth | None = None
+        self._basic_auth_credentials: tuple[str, str] | None = None
+        self._current_user_id: str | None = None
+        self._last_user_response: Response | None = None
+        self._last_user_response_at = 0.0
+        self._keep_alive_stop = threading.Event()
+        self._keep_alive_thread: threading.Thread | None = None
+        # Bound once, so frequent requests skip looking up the session and its method on every call
+        self._get = self.session.get
+        self._put = self.session.put
+        self._post = self.session.post
 
     def authenticate(self, login: str, password: str, mfa_code: str | None = None) -> None:
         """Authenticate through all layers."""
@@ -40,11 +107,13 @@ class VRChatAPI:
         Load cookies from local storage.
         If none found send a request to login use with the given credentials.
         Save cookies in case of success.
+        Credentials are encoded only when they differ from the previous ones. If none are given, the previous ones are
+        reused until a login with them fails.
 
         :param login: VRChat login.
         :param password: VRChat password.
         """
-        logger.info("Checking if there are any cookies to load at %s", Path(self.COOKIES_FILE_PATH).absolute())
+        logger.info("Checking if there are any cookies to load at %s", self._cookies_path.absolute())
         self._load_cookies()
         if self.session.cookies:
             logger.info("Cookies were found in the local storage. Validating them...")
@@ -55,10 +124,12 @@ class VRChatAPI:
             else:
                 logger.info("Cookies has expired. New login is required")
 
+        if not login and not password and self._basic_auth_credentials:
+            login, password = self._basic_auth_credentials
         if not login:
-            input("Login: ")
+            login = input("Login: ")
         if not password:
-            input("Password: ")
+            password = input("Password: ")
 
         if not login or not password:
             raise ValueError("Login and password were not provided. Unable to authenticate with the VRChat API")
@@ -66,32 +137,48 @@ class VRChatAPI:
             raise ValueError("Login was not provided. Unable to authenticate with the VRChat API")
         if not password:
             raise ValueError("Password was not provided. Unable to authenticate with the VRChat API")
+        self._set_basic_auth(login, password)
 
         logger.info("Making login")
-        login_response = self.login(login, password)
+        login_response = self.login()
         if login_response.ok:
             self._save_cookies()
             logger.info(f"Login success. Cookies were saved")
             self.log_authentication_cookie_expiration_date()
-        elif login_response.status_code == codes.forbidden:
+            return None
+
+        self._basic_auth = None
+        self._basic_auth_credentials = None
+        if login_response.status_code == codes.forbidden:
             logger.error(
                 f"Authentication failed. High-likely invalid credentials were provided. Response: {login_response.text}"
             )
-            login_response.raise_for_status()
         else:
             logger.error(f"Something went wrong during VRChat authentication. Response: {login_response.text}")
-            login_response.raise_for_status()
+        login_response.raise_for_status()
         return None
 
+    def _set_basic_auth(self, login: str, password: str) -> None:
+        """Encode the given credentials for the basic authentication unless they are already encoded."""
+        if (login, password) != self._basic_auth_credentials:
+            self._basic_auth = HTTPBasicAuth(urllib.parse.quote(login), urllib.parse.quote(password))
+            self._basic_auth_credentials = (login, password)
+
     def mfa_authentication(self, mfa_code: str | None = None) -> None:
         """Checks if MFA Authentication is needed and performs it.
 
+        If the code is rejected, a new one will be asked after an exponential delay with jitter.
+
         :param mfa_code: Optional MFA code. If empty console input will be asked.
         """
         logger.debug("Checking if Multi-factor Authentication is needed...")
-        get_user_response = self.get_current_user()
-        if mfa_methods := get_user_response.json().get("requiresTwoFactorAuth"):
-            logger.info("Multi-factor Authentication is needed. Available options: %s", mfa_methods)
+        get_user_response = self._get_recent_current_user()
+        if not (mfa_methods := get_user_response.json().get("requiresTwoFactorAuth")):
+            logger.info("Multi-factor Authentication is not needed")
+            return None
+
+        logger.info("Multi-factor Authentication is needed. Available options: %s", mfa_methods)
+        for attempt in range(1, self.MFA_MAX_ATTEMPTS + 1):
             while not mfa_code:
                 method = "MFA Application" if "totp" in mfa_methods else "email code"
                 mfa_code = input(
@@ -100,7 +187,7 @@ class VRChatAPI:
                 )
             if "totp" in mfa_methods:
                 verify_response = self.verify_totp(mfa_code)
-            elif "emailotp" in mfa_code:
+            elif "emailotp" in mfa_methods:
                 verify_response = self.verify_emailotp(mfa_code)
             else:
                 raise NotImplementedError("Multi-factor Authentication methods %s are not supported", mfa_methods)
@@ -108,63 +195,142 @@ class VRChatAPI:
             if verify_response.ok:
                 logger.info("MFA success. Saving cookies")
                 self._save_cookies()
-            elif verify_response.status_code == codes.bad_request:
-                logger.error(f"Multi-factor Authentication has failed. Retrying...")
-                self.mfa_authentication()
-            else:
+                return None
+            elif verify_response.status_code != codes.bad_request:
                 logger.error(f"Something went wrong during VRChat MFA verify. Response: {verify_response.text}")
                 verify_response.raise_for_status()
-        else:
-            logger.info("Multi-factor Authentication is not needed")
+                return None
+            elif attempt < self.MFA_MAX_ATTEMPTS:
+                delay = random.uniform(0, min(self.MFA_RETRY_MAX_WAIT_SECONDS, 2**attempt))
+                logger.error(f"Multi-factor Authentication has failed. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+                mfa_code = None
+
+        logger.error(f"Multi-factor Authentication has failed {self.MFA_MAX_ATTEMPTS} times")
+        verify_response.raise_for_status()
+        return None
 
     def verify_totp(self, code: str) -> Response:
         """Send POST request to verify MFA TOTP code."""
-        response = self.session.post(url=f"{self.BASE_URL}/auth/twofactorauth/totp/verify", json={"code": code})
-        return response
+        return self._verify_mfa_code(f"{self.BASE_URL}/auth/twofactorauth/totp/verify", code)
 
     def verify_emailotp(self, code: str) -> Response:
         """Send POST request to verify MFA email code."""
-        response = self.session.post(url=f"{self.BASE_URL}/auth/twofactorauth/emailotp/verify", json={"code": code})
+        return self._verify_mfa_code(f"{self.BASE_URL}/auth/twofactorauth/emailotp/verify", code)
+
+    @retry_on_rate_limit
+    def _verify_mfa_code(self, url: str, code: str) -> Response:
+        """Send POST request with the MFA code serialized into JSON body to the given verify URL."""
+        response = self._post(url=url, data=orjson.dumps({"code": code}), headers=self.JSON_HEADERS)
         return response
 
     def get_current_user(self) -> Response:
         """Send GET request to get the current user."""
-        response = self.session.get(f"{self.BASE_URL}/auth/user")
+        response = self._get(f"{self.BASE_URL}/auth/user")
+        self._remember_current_user_response(response)
         return response
 
-    def login(self, login: str, password: str) -> Response:
+    def login(self) -> Response:
         """Send GET request with encoded login/password to get the authentication cookie."""
-        authentication = HTTPBasicAuth(urllib.parse.quote(login), urllib.parse.quote(password))
-        response = self.session.get(url=f"{self.BASE_URL}/auth/user", auth=authentication)
+        self._current_user_id = None
+        response = self._get(url=f"{self.BASE_URL}/auth/user", auth=self._basic_auth)
+        self._remember_current_user_response(response)
         return response
 
+    def start_keep_alive(self) -> None:
+        """Start sending cheap requests in the background to keep the pooled connection warm between switches."""
+        if self._keep_alive_thread is not None and self._keep_alive_thread.is_alive():
+            return None
+        self._keep_alive_stop.clear()
+        self._keep_alive_thread = threading.Thread(target=self._keep_alive, name="vrchat-keep-alive", daemon=True)
+        self._keep_alive_thread.start()
+        return None
+
+    def stop_keep_alive(self) -> None:
+        """Stop sending background keep-alive requests and wait for the background thread to finish."""
+        self._keep_alive_stop.set()
+        if self._keep_alive_thread is not None:
+            self._keep_alive_thread.join()
+            self._keep_alive_thread = None
+
+    def _keep_alive(self) -> None:
+        """Send GET request to get the current user every keep-alive interval until stopped."""
+        while not self._keep_alive_stop.wait(self.KEEP_ALIVE_INTERVAL_SECONDS):
+            try:
+                self._get(f"{self.BASE_URL}/auth/user", timeout=self.KEEP_ALIVE_TIMEOUT_SECONDS)
+            except RequestException as error:
+                logger.debug("Keep-alive request has failed: %s", error)
+
+    def get_current_user_id(self) -> str | None:
+        """Return the id of the authenticated user, sending GET request to get the current user if it is not known.
+
+        :return: Current user id, None if the current user could not be received.
+        """
+        if self._current_user_id is None:
+            self.get_current_user()
+        return self._current_user_id
+
+    def _remember_current_user_response(self, response: Response) -> None:
+        """Remember the current user response, the time it was received and the user id if it has one."""
+        self._last_user_response = response
+        self._last_user_response_at = time.monotonic()
+        if response.ok and (user_id := response.json().get("id")):
+            self._current_user_id = user_id
+
+    def _get_recent_current_user(self) -> Response:
+        """Return the current user response received just before, otherwise send GET request to get the current user.
+
+        The remembered response is used only once, so every next call will send a new request.
+        """
+        last_user_response, self._last_user_response = self._last_user_response, None
+        if last_user_response is not None and (
+            time.monotonic() - self._last_user_response_at < self.CURRENT_USER_REUSE_SECONDS
+        ):
+            logger.debug("Reusing the current user response received just before")
+            return last_user_response
+        return self.get_current_user()
+
+    @retry_on_rate_limit
     def switch_avatar(self, avatar_id: str) -> Response:
         """Send a PUT request to switch to the given avatar by its ID."""
-        response = self.session.put(f"{self.BASE_URL}/avatars/{avatar_id}/select")
+        response = self._put(self.SWITCH_AVATAR_URL_TEMPLATE.format(avatar_id))
         return response
 
-    def get_avatars(self) -> Response:
+    @retry_on_rate_limit
+    def get_avatars(self, offset: int = 0, etag: str | None = None) -> Response:
         """Send GET avatar with the given query.
 
+        :param offset: Number of favorite avatars to skip before the requested page.
+        :param etag: Optional ETag of the previous response. If it still matches, 304 response will be returned.
         :return: Response to request to get avatars using given query.
         """
-        response = self.session.get(url=f"{self.BASE_URL}/avatars/favorites?featured=true")
+        params = {"featured": "true", "n": self.FAVORITE_AVATARS_PAGE_SIZE, "offset": offset}
+        headers = {"If-None-Match": etag} if etag else None
+        response = self._get(url=f"{self.BASE_URL}/avatars/favorites", params=params, headers=headers)
         return response
 
     def _save_cookies(self) -> None:
-        """Transform cookies from the current session into a cookie jar and save them locally."""
-        cookies_jar = dict_from_cookiejar(self.session.cookies)
-        Path(self.COOKIES_FILE_PATH).write_text(json.dumps(cookies_jar))
+        """Save cookies from the current session locally in Mozilla format, keeping their domains and expiration."""
+        cookies_jar = MozillaCookieJar(self._cookies_path)
+        for cookie in self.session.cookies:
+            cookies_jar.set_cookie(cookie)
+        cookies_jar.save(ignore_discard=True)
 
     def _load_cookies(self) -> None:
-        """Load cookies from the file and set them in the current session."""
-        if os.path.exists(self.COOKIES_FILE_PATH):
-            cookies = json.loads(Path(self.COOKIES_FILE_PATH).read_text())
-            cookies_jar = cookiejar_from_dict(cookies)
-            self.session.cookies = cookies_jar
+        """Load not expired cookies from the file and set them in the current session."""
+        cookies_jar = MozillaCookieJar(self._cookies_path)
+        try:
+            cookies_jar.load(ignore_discard=True)
+        except FileNotFoundError:
+            return None
+        except LoadError as error:
+            logger.warning("Ignoring cookies file at %s with invalid format: %s", self._cookies_path.absolute(), error)
+            return None
+        self.session.cookies.update(cookies_jar)
 
     def log_authentication_cookie_expiration_date(self) -> None:
         """Log the time when the authentication cookie will expire."""
-        if authentication_cookie := [cookie for cookie in self.session.cookies if cookie.name == "auth"][0]:
+        authentication_cookie = next((cookie for cookie in self.session.cookies if cookie.name == "auth"), None)
+        if authentication_cookie and authentication_cookie.expires:
             expiration_time = datetime.fromtimestamp(int(authentication_cookie.expires))
             logger.info(f"Authentication cookies expire at: {expiration_time}")
@@ -29,14 +29,20 @@ def console_switch() -> None:
     vrchat_api.authenticate(login, password, mfa_code)
     avatar_switcher = AvatarSwitcher(vrchat_api)
     avatars_map = AVATARS_MAP or avatar_switcher.get_all_favorite_avatars()
-    while True:
-        avatar_name = input("Waiting for avatar name: ")
-        try:
-            avatar_switcher.switch_avatar_by_name(avatars_map, avatar_name)
-        except AuthenticationRequiredError:
-            vrchat_api.authenticate(login, password)
-        except AvatarNotFoundError as error:
-            logger.error(error)
+    vrchat_api.start_keep_alive()
+    try:
+        while True:
+            avatar_name = input("Waiting for avatar name: ")
+            try:
+                avatar_switcher.switch_avatar_by_name(avatars_map, avatar_name)
+            except AuthenticationRequiredError:
+                vrchat_api.authenticate(login, password)
+                avatar_switcher.clear_favorite_avatars_cache()
+                avatars_map = AVATARS_MAP or avatar_switcher.get_all_favorite_avatars()
+            except AvatarNotFoundError as error:
+                logger.error(error)
+    finally:
+        vrchat_api.stop_keep_alive()
 
 
 if __name__ == "__main__":